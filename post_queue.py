@@ -11,14 +11,23 @@ from __future__ import annotations
 
 import os
 import json
+import time
+import random
+import functools
+import hashlib
+import heapq
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from typing import Optional, List, Dict, Any, Tuple
+from typing import Optional, List, Dict, Any, Tuple, Callable, TypeVar
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
 
 # ===== Settings =====
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
@@ -34,36 +43,166 @@ HEADERS: List[str] = [
     "error_message",
 ]
 
+SHEETS_API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+
 TWEET_URL = "https://api.x.com/2/tweets"
 MEDIA_UPLOAD_URL = "https://upload.twitter.com/1.1/media/upload.json"
+MEDIA_CHUNK_SIZE = 4 * 1024 * 1024  # APPEND 1回あたり（上限 5MB）
+MEDIA_PROCESSING_TIMEOUT_SEC = 300  # 動画/GIF のサーバ側処理を待つ上限（cron 間隔より短く）
 
-MAX_TWEET_LEN = 280  # 日本語でも280（念のためガード）
+# 同じ画像は media_id を使い回す（X の media_id は約24時間有効なので余裕をみて23時間）
+MEDIA_CACHE_FILE = os.getenv("MEDIA_CACHE_FILE", ".media_cache.json")
+MEDIA_CACHE_TTL_SEC = 23 * 3600
 
+VALID_STATUSES = frozenset({"PENDING", "READY"})  # 投稿対象にする status
 
-def now_jst_str() -> str:
-    return datetime.now(JST).strftime("%Y-%m-%d %H:%M")
+MAX_TWEET_LEN = 280  # 日本語でも280（念のためガード）
+
+# X API のクライアント側レート制限（固定窓）: RATE_WINDOW_SEC あたり RATE_LIMIT リクエストまで。
+# 投稿とメディアアップロードは同じ枠を消費する。枠が足りない行は次回の実行に回す
+RATE_LIMIT = 50
+RATE_WINDOW_SEC = 900
+
+POST_CONCURRENCY = 4  # MAX_POSTS_PER_RUN>1 のときの同時メディアアップロード数（控えめに）
+
+HEADER_CACHE_SEC = 600  # ヘッダー検証結果をプロセス内で使い回す秒数
+
+# 429/5xx のときだけリトライ（指数バックオフ + ジッター、Retry-After の方が長ければそれに従う）
+# ただし Retry-After が RETRY_CAP_SEC を超えるときはリトライせずにエラーにする
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# 投稿 (POST /2/tweets) は冪等でない。5xx でも作成済みのことがあり、再送すると
+# duplicate content (403) になるので 429 だけリトライする
+RETRY_STATUSES_NON_IDEMPOTENT = (429,)
+RETRY_MAX = 3
+RETRY_BASE_SEC = 1.0
+RETRY_CAP_SEC = 30.0
+RETRY_JITTER = 0.5
+
+T = TypeVar("T")
+
+# X / Sheets API 向けの HTTP 接続はプロセス内で使い回す（TLS ハンドシェイクを1回に）
+# リトライは @retry 側で行うので urllib3 のリトライは無効
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=0))
+
+
+def _retry_info(e: Exception, statuses: Tuple[int, ...]) -> Optional[Tuple[int, float]]:
+    """リトライ対象なら (status, Retry-After秒) を返す。対象外なら None"""
+    if not isinstance(e, requests.HTTPError) or e.response is None:
+        return None
+    status = e.response.status_code
+    retry_after = e.response.headers.get("Retry-After")
+
+    if status not in statuses:
+        return None  # 429 以外の 4xx はリトライしても無駄
+    try:
+        wait = float(retry_after) if retry_after else 0.0
+    except ValueError:
+        wait = 0.0  # HTTP-date 形式は無視してバックオフに任せる
+    return status, wait
+
+
+def retry(
+    statuses: Tuple[int, ...] = RETRY_STATUSES,
+) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """statuses のステータスで失敗したときだけリトライするデコレータ"""
+    def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs) -> T:
+            for attempt in range(RETRY_MAX + 1):
+                try:
+                    return func(*args, **kwargs)
+                except requests.HTTPError as e:
+                    info = _retry_info(e, statuses)
+                    if info is None or attempt >= RETRY_MAX:
+                        raise
+                    status, retry_after = info
+                    if retry_after > RETRY_CAP_SEC:
+                        raise  # 長すぎる Retry-After は待たずにエラー（次の cron と重ならないように）
+                    backoff = min(RETRY_CAP_SEC, RETRY_BASE_SEC * 2 ** attempt)
+                    backoff *= 1 + random.uniform(0, RETRY_JITTER)
+                    wait = max(backoff, retry_after)
+                    print(f"RETRY {func.__name__} status={status} wait={wait:.1f}s")
+                    time.sleep(wait)
+            raise AssertionError("unreachable")
+
+        return wrapper
+
+    return decorator
+
+
+def raise_for_status(res: requests.Response, what: str):
+    """レスポンス本文込みのメッセージで requests.HTTPError を投げる"""
+    if res.status_code >= 400:
+        raise requests.HTTPError(f"{what} failed: {res.status_code} {res.text}", response=res)
+
+
+_token_lock = threading.Lock()
+
+
+def sheets_token(creds: Credentials) -> str:
+    """アクセストークンは期限 (creds.expiry) までは使い回し、切れたら取り直す"""
+    with _token_lock:
+        if not creds.valid:
+            creds.refresh(GoogleAuthRequest(session=SESSION))
+        return creds.token
+
+
+@retry()
+def sheets_call(
+    creds: Credentials,
+    method: str,
+    path: str,
+    params: Optional[Dict[str, Any]] = None,
+    body: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Sheets REST API を直接呼ぶ（path は SHEETS_API_URL 以降, 例: '/{id}/values:batchGet'）"""
+    res = SESSION.request(
+        method,
+        SHEETS_API_URL + path,
+        headers={"Authorization": f"Bearer {sheets_token(creds)}"},
+        params=params,
+        json=body,
+        timeout=60,
+    )
+    raise_for_status(res, f"sheets {path.rsplit(':', 1)[-1]}")
+    return res.json() if res.content else {}
 
 
 def parse_scheduled_at(s: str) -> datetime:
     """scheduled_at: 'YYYY-MM-DD HH:MM' (JST前提)"""
-    return datetime.strptime(s.strip(), "%Y-%m-%d %H:%M").replace(tzinfo=JST)
+    s = s.strip()
+    # 定型 'YYYY-MM-DD HH:MM' はスライス + int() で直接組み立てる（strptime より速い）
+    if (
+        len(s) == 16
+        and s[4] == "-" and s[7] == "-" and s[10] == " " and s[13] == ":"
+        and (s[0:4] + s[5:7] + s[8:10] + s[11:13] + s[14:16]).isdigit()
+    ):
+        return datetime(
+            int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), tzinfo=JST
+        )
+    # '2025-1-5 9:00' のようなゆるい書式は strptime に任せる
+    return datetime.strptime(s, "%Y-%m-%d %H:%M").replace(tzinfo=JST)
 
 
-def get_sheets_service(service_account_file: str, service_account_json: Optional[str] = None):
+@functools.lru_cache(maxsize=1)
+def get_sheets_credentials(
+    service_account_file: str, service_account_json: Optional[str] = None
+) -> Credentials:
     """
     優先順位:
       1) service_account_file が存在 -> それを使う
       2) envの JSON文字列 (GOOGLE_SERVICE_ACCOUNT_JSON) -> それを使う
+
+    プロセス内では1度だけ読み込む（アクセストークンも creds 上でキャッシュされる）。
     """
     p = Path(service_account_file)
     if p.exists():
-        creds = Credentials.from_service_account_file(str(p), scopes=SCOPES)
-        return build("sheets", "v4", credentials=creds)
+        return Credentials.from_service_account_file(str(p), scopes=SCOPES)
 
     if service_account_json:
         data = json.loads(service_account_json)
-        creds = Credentials.from_service_account_info(data, scopes=SCOPES)
-        return build("sheets", "v4", credentials=creds)
+        return Credentials.from_service_account_info(data, scopes=SCOPES)
 
     raise RuntimeError(
         "Service account credentials not found. "
@@ -71,93 +210,336 @@ def get_sheets_service(service_account_file: str, service_account_json: Optional
     )
 
 
-def ensure_header(svc, spreadsheet_id: str, sheet_name: str):
-    rng = f"{sheet_name}!A1:G1"
-    resp = svc.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=rng).execute()
-    values = resp.get("values", [])
+# (spreadsheet_id, sheet_name) -> ヘッダー検証OKの有効期限 (time.monotonic())
+_header_ok_until: Dict[Tuple[str, str], float] = {}
+
+
+def header_ok(spreadsheet_id: str, sheet_name: str) -> bool:
+    return time.monotonic() < _header_ok_until.get((spreadsheet_id, sheet_name), 0.0)
+
+
+def ensure_header(spreadsheet_id: str, sheet_name: str, values: List[List[str]]):
     if not values or values[0] != HEADERS:
         raise RuntimeError(
             "Header mismatch.\n"
             f"Expected: {HEADERS}\n"
             f"Got: {values[0] if values else None}"
         )
+    _header_ok_until[(spreadsheet_id, sheet_name)] = time.monotonic() + HEADER_CACHE_SEC
+
+
+def next_row_key(sheet_name: str) -> str:
+    return f"x_autopost_next_row:{sheet_name}"
+
+
+# 同じ X アカウントの投稿数をシート単位ではなくスプレッドシート全体で数える
+RATE_WINDOW_KEY = "x_autopost_rate_window"
+
+
+def read_metadata(
+    creds: Credentials, spreadsheet_id: str, keys: List[str]
+) -> Dict[str, Tuple[int, str]]:
+    """DeveloperMetadata を1回の search でまとめて読む -> {key: (metadataId, value)}"""
+    resp = sheets_call(
+        creds,
+        "POST",
+        f"/{spreadsheet_id}/developerMetadata:search",
+        body={"dataFilters": [{"developerMetadataLookup": {"metadataKey": k}} for k in keys]},
+    )
+    found: Dict[str, Tuple[int, str]] = {}
+    for m in resp.get("matchedDeveloperMetadata", []):
+        md = m.get("developerMetadata", {})
+        key = md.get("metadataKey")
+        if key in keys and key not in found and "metadataId" in md:
+            found[key] = (md["metadataId"], md.get("metadataValue", ""))
+    return found
+
+
+def save_metadata(creds: Credentials, spreadsheet_id: str, items: List[Tuple[str, Optional[int], str]]):
+    """(key, metadataId or None, value) を spreadsheets.batchUpdate 1回で作成/更新する"""
+    if not items:
+        return
+    reqs: List[Dict[str, Any]] = []
+    for key, metadata_id, value in items:
+        if metadata_id is None:
+            reqs.append(
+                {
+                    "createDeveloperMetadata": {
+                        "developerMetadata": {
+                            "metadataKey": key,
+                            "metadataValue": value,
+                            "location": {"spreadsheet": True},
+                            "visibility": "DOCUMENT",
+                        }
+                    }
+                }
+            )
+        else:
+            reqs.append(
+                {
+                    "updateDeveloperMetadata": {
+                        "dataFilters": [{"developerMetadataLookup": {"metadataId": metadata_id}}],
+                        "developerMetadata": {"metadataValue": value},
+                        "fields": "metadataValue",
+                    }
+                }
+            )
+    sheets_call(creds, "POST", f"/{spreadsheet_id}:batchUpdate", body={"requests": reqs})
+
+
+def parse_cursor(value: Optional[str]) -> Tuple[int, str]:
+    """
+    「未投稿の先頭行」カーソル 'next_row,tweet_id' -> (next_row, 直前行の tweet_id)。
+    直前行の tweet_id は、行の削除/並べ替えでカーソルがずれていないかの確認に使う。
+    未作成/壊れていれば (2, "")（データ先頭から読む）
+    """
+    try:
+        row_s, tweet_id = (value or "").split(",", 1)
+        return max(2, int(row_s)), tweet_id
+    except ValueError:
+        return 2, ""
+
+
+def parse_rate_window(value: Optional[str], now_ts: float) -> Tuple[float, int]:
+    """'window_start,count' -> (window_start, count)。窓が終わっていれば新しい窓を始める"""
+    try:
+        start_s, count_s = (value or "").split(",")
+        start, count = float(start_s), int(count_s)
+    except ValueError:
+        return now_ts, 0
+    if now_ts - start >= RATE_WINDOW_SEC or start > now_ts:
+        return now_ts, 0
+    return start, count
+
+
+def request_cost(r: Dict[str, Any]) -> int:
+    """
+    1行の投稿で X API に投げるリクエスト数の上限見積もり（投稿 + メディアがあればアップロード）。
+    枠への加算は post_rows が返す実際の送信数で行う
+    """
+    return 2 if r["media_path"] else 1
 
 
-def read_queue_rows(svc, spreadsheet_id: str, sheet_name: str) -> List[Dict[str, Any]]:
-    rng = f"{sheet_name}!A1:G"
-    resp = svc.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=rng).execute()
-    values = resp.get("values", [])
+def read_queue_rows(
+    creds: Credentials, spreadsheet_id: str, sheet_name: str, start_row: int = 2
+) -> List[Dict[str, Any]]:
+    """
+    ヘッダー(A1:G1)とデータ(A{start_row}:G)を values.batchGet 1回で取得する。
+    ヘッダーは検証済み(HEADER_CACHE_SEC 以内)ならデータだけ取得する
+    """
+    ranges = [f"{sheet_name}!A{start_row}:G"]
+    check_header = not header_ok(spreadsheet_id, sheet_name)
+    if check_header:
+        ranges.insert(0, f"{sheet_name}!A1:G1")
+    resp = sheets_call(
+        creds, "GET", f"/{spreadsheet_id}/values:batchGet", params={"ranges": ranges}
+    )
+    value_ranges = resp.get("valueRanges", [])
+    if len(value_ranges) != len(ranges):
+        raise RuntimeError(f"unexpected batchGet response: {resp}")
+
+    if check_header:
+        ensure_header(spreadsheet_id, sheet_name, value_ranges[0].get("values", []))
+
+    values = value_ranges[-1].get("values", [])
     if not values:
         return []
 
-    header = values[0]
-    if header != HEADERS:
-        raise RuntimeError(f"Header mismatch: expected {HEADERS}, got {header}")
-
+    # 値 (FORMATTED_VALUE なので常に str) はここで1度だけ strip して、以降はそのまま使う
     rows: List[Dict[str, Any]] = []
-    for i, row in enumerate(values[1:], start=2):
+    for i, row in enumerate(values, start=start_row):
         row = row + [""] * (len(HEADERS) - len(row))
         rows.append(
             {
                 "row_index": i,
-                "scheduled_at": row[0],
-                "text": row[1],
-                "media_path": row[2],
-                "status": row[3],
-                "posted_at": row[4],
-                "tweet_id": row[5],
-                "error_message": row[6],
+                "scheduled_at": row[0].strip(),
+                "text": row[1].strip(),
+                "media_path": row[2].strip(),
+                "status": row[3].strip(),
+                "posted_at": row[4].strip(),
+                "tweet_id": row[5].strip(),
+                "error_message": row[6].strip(),
             }
         )
     return rows
 
 
-def update_row_full(
-    svc,
-    spreadsheet_id: str,
+def update_row_status(
+    pending_writes: List[Dict[str, Any]],
     sheet_name: str,
     row_index: int,
-    new_row_7cols: List[str],
+    status: str,
+    posted_at: str,
+    tweet_id: str,
+    error_message: str,
 ):
-    if len(new_row_7cols) != 7:
-        raise ValueError("new_row_7cols must have 7 columns (A..G)")
-    rng = f"{sheet_name}!A{row_index}:G{row_index}"
-    svc.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range=rng,
-        valueInputOption="RAW",
-        body={"values": [new_row_7cols]},
-    ).execute()
-
-
-def upload_media(auth: OAuth1, media_path: str) -> str:
-    """X v1.1 media upload -> media_id_string"""
+    """
+    変化する D..G 列（status | posted_at | tweet_id | error_message）だけを pending_writes に積む
+    （書き込みは flush_writes でまとめて行う）
+    """
+    rng = f"{sheet_name}!D{row_index}:G{row_index}"
+    pending_writes.append({"range": rng, "values": [[status, posted_at, tweet_id, error_message]]})
+
+
+def flush_writes(creds: Credentials, spreadsheet_id: str, pending_writes: List[Dict[str, Any]]):
+    """積まれた更新を values.batchUpdate 1回で書き込む"""
+    if not pending_writes:
+        return
+    sheets_call(
+        creds,
+        "POST",
+        f"/{spreadsheet_id}/values:batchUpdate",
+        body={"valueInputOption": "RAW", "data": pending_writes},
+    )
+    pending_writes.clear()
+
+
+def media_category(media_type: str) -> str:
+    if media_type == "image/gif":
+        return "tweet_gif"
+    if media_type.startswith("video/"):
+        return "tweet_video"
+    return "tweet_image"
+
+
+@retry()
+def media_command(
+    auth: OAuth1,
+    data: Dict[str, Any],
+    files: Optional[Dict[str, Any]] = None,
+    method: str = "POST",
+) -> Dict[str, Any]:
+    """media/upload.json への1リクエスト（チャンク単位でリトライされる）"""
+    if method == "GET":
+        res = SESSION.get(MEDIA_UPLOAD_URL, auth=auth, params=data, timeout=30)
+    else:
+        res = SESSION.post(MEDIA_UPLOAD_URL, auth=auth, data=data, files=files, timeout=60)
+    raise_for_status(res, f"media {data['command']}")
+    # APPEND は 2xx + 空ボディ
+    return res.json() if res.content else {}
+
+
+# sha256(ファイル内容) -> {"media_id": str, "uploaded_at": epoch秒}
+_media_cache: Optional[Dict[str, Dict[str, Any]]] = None
+_media_cache_lock = threading.Lock()
+# 同じ内容のファイルを並列で同時にアップロードしないよう、digest ごとにロックする
+_media_digest_locks: Dict[str, threading.Lock] = {}
+
+
+def load_media_cache() -> Dict[str, Dict[str, Any]]:
+    global _media_cache
+    if _media_cache is None:
+        try:
+            data = json.loads(Path(MEDIA_CACHE_FILE).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            data = None
+        _media_cache = data if isinstance(data, dict) else {}
+    return _media_cache
+
+
+def save_media_cache(cache: Dict[str, Dict[str, Any]]):
+    now_ts = time.time()
+    live = {k: v for k, v in cache.items() if now_ts - v["uploaded_at"] < MEDIA_CACHE_TTL_SEC}
+    Path(MEDIA_CACHE_FILE).write_text(json.dumps(live), encoding="utf-8")
+
+
+def upload_media(
+    auth: OAuth1, media_path: str, on_upload: Optional[Callable[[], None]] = None
+) -> str:
+    """
+    同じ内容のファイルを TTL 内にアップロード済みならその media_id を返す。
+    実際にアップロードするときだけ、開始前に on_upload() を呼ぶ
+    """
     p = Path(media_path)
     if not p.is_file():
         raise FileNotFoundError(f"media_path not found: {media_path}")
 
     with p.open("rb") as f:
-        files = {"media": f}
-        res = requests.post(MEDIA_UPLOAD_URL, auth=auth, files=files, timeout=60)
+        key = hashlib.file_digest(f, "sha256").hexdigest()
+
+    with _media_cache_lock:
+        digest_lock = _media_digest_locks.setdefault(key, threading.Lock())
+
+    # 参照 -> アップロード -> 登録 を digest 単位でまとめて排他（後続は先行分のキャッシュを使う）
+    with digest_lock:
+        with _media_cache_lock:
+            hit = load_media_cache().get(key)
+        if hit and time.time() - hit["uploaded_at"] < MEDIA_CACHE_TTL_SEC:
+            print(f"MEDIA cache hit {media_path} media_id={hit['media_id']}")
+            return hit["media_id"]
+
+        if on_upload is not None:
+            on_upload()
+        media_id = upload_media_chunked(auth, p)
+
+        with _media_cache_lock:
+            cache = load_media_cache()
+            cache[key] = {"media_id": media_id, "uploaded_at": time.time()}
+            try:
+                save_media_cache(cache)
+            except OSError as e:
+                print(f"WARN media cache not saved: {e}")
+        return media_id
+
+
+def upload_media_chunked(auth: OAuth1, p: Path) -> str:
+    """X v1.1 chunked media upload (INIT -> APPEND... -> FINALIZE) -> media_id_string"""
+    media_type = mimetypes.guess_type(p.name)[0] or "application/octet-stream"
+
+    js = media_command(
+        auth,
+        {
+            "command": "INIT",
+            "total_bytes": p.stat().st_size,
+            "media_type": media_type,
+            "media_category": media_category(media_type),
+        },
+    )
+    media_id = js.get("media_id_string") or (str(js["media_id"]) if js.get("media_id") else "")
+    if not media_id:
+        raise RuntimeError(f"media INIT ok but media_id missing: {js}")
 
-    if res.status_code >= 400:
-        raise RuntimeError(f"media upload failed: {res.status_code} {res.text}")
+    with p.open("rb") as f:
+        segment_index = 0
+        while True:
+            chunk = f.read(MEDIA_CHUNK_SIZE)
+            if not chunk:
+                break
+            media_command(
+                auth,
+                {"command": "APPEND", "media_id": media_id, "segment_index": segment_index},
+                files={"media": chunk},
+            )
+            segment_index += 1
+
+    js = media_command(auth, {"command": "FINALIZE", "media_id": media_id})
+
+    # 動画/GIF はサーバ側の処理完了を待つ（上限を超えたらエラーにして次の行へ）
+    deadline = time.monotonic() + MEDIA_PROCESSING_TIMEOUT_SEC
+    info = js.get("processing_info")
+    while info and info.get("state") in ("pending", "in_progress"):
+        wait = info.get("check_after_secs", 1)
+        if time.monotonic() + wait > deadline:
+            raise RuntimeError(
+                f"media processing timed out after {MEDIA_PROCESSING_TIMEOUT_SEC}s: {info}"
+            )
+        time.sleep(wait)
+        js = media_command(auth, {"command": "STATUS", "media_id": media_id}, method="GET")
+        info = js.get("processing_info")
+    if info and info.get("state") == "failed":
+        raise RuntimeError(f"media processing failed: {info}")
 
-    js = res.json()
-    media_id = js.get("media_id_string") or str(js.get("media_id"))
-    if not media_id:
-        raise RuntimeError(f"media upload ok but media_id missing: {js}")
     return media_id
 
 
+@retry(RETRY_STATUSES_NON_IDEMPOTENT)
 def post_to_x(auth: OAuth1, text: str, media_id: Optional[str] = None) -> str:
     payload: Dict[str, Any] = {"text": text}
     if media_id:
         payload["media"] = {"media_ids": [media_id]}
 
-    res = requests.post(TWEET_URL, auth=auth, json=payload, timeout=30)
-    if res.status_code >= 400:
-        raise RuntimeError(f"tweet post failed: {res.status_code} {res.text}")
+    res = SESSION.post(TWEET_URL, auth=auth, json=payload, timeout=30)
+    raise_for_status(res, "tweet post")
 
     js = res.json()
     tid = js.get("data", {}).get("id")
@@ -166,6 +548,57 @@ def post_to_x(auth: OAuth1, text: str, media_id: Optional[str] = None) -> str:
     return tid
 
 
+def prepare_row(
+    auth: OAuth1, r: Dict[str, Any], on_upload: Optional[Callable[[], None]] = None
+) -> Optional[str]:
+    """1行分の投稿前処理: 本文チェックと(あれば)メディアのアップロード -> media_id"""
+    text = r["text"]
+    if len(text) > MAX_TWEET_LEN:
+        raise ValueError(f"text too long: {len(text)} (limit {MAX_TWEET_LEN})")
+
+    media_path = r["media_path"]
+    if media_path:
+        return upload_media(auth, media_path, on_upload)
+    return None
+
+
+def post_rows(
+    auth: OAuth1, rows: List[Dict[str, Any]]
+) -> Tuple[List[Tuple[Dict[str, Any], Optional[str], Optional[Exception]]], int]:
+    """
+    時間のかかるメディアアップロードだけ最大 POST_CONCURRENCY 並列で行い、
+    投稿は rows の順（= scheduled_at 順）に1件ずつ行う（タイムラインの順序を崩さない）。
+    戻り値は (rows と同じ順の (row, tweet_id, error), 実際に X に送ったリクエスト数)。
+    リクエスト数はアップロード1回・投稿1回をそれぞれ1と数える（キャッシュヒットや送信前のエラーは0）
+    """
+    uploads: List[None] = []  # list.append はスレッド間でも安全
+
+    def prepare(r: Dict[str, Any]) -> Tuple[Optional[str], Optional[Exception]]:
+        try:
+            return prepare_row(auth, r, lambda: uploads.append(None)), None
+        except Exception as e:
+            return None, e
+
+    if sum(1 for r in rows if r["media_path"]) <= 1:
+        prepared = [prepare(r) for r in rows]
+    else:
+        with ThreadPoolExecutor(max_workers=min(POST_CONCURRENCY, len(rows))) as ex:
+            prepared = list(ex.map(prepare, rows))
+
+    results: List[Tuple[Dict[str, Any], Optional[str], Optional[Exception]]] = []
+    sent = len(uploads)
+    for r, (media_id, err) in zip(rows, prepared):
+        if err is None:
+            sent += 1
+            try:
+                results.append((r, post_to_x(auth, r["text"], media_id=media_id), None))
+                continue
+            except Exception as e:
+                err = e
+        results.append((r, None, err))
+    return results, sent
+
+
 def run():
     enable_run = os.getenv("ENABLE_RUN", "true").lower() in ("1", "true", "yes", "y", "on")
     if not enable_run:
@@ -197,84 +630,152 @@ def run():
         os.environ["X_ACCESS_TOKEN_SECRET"],
     )
 
-    svc = get_sheets_service(service_account_file, service_account_json)
-    ensure_header(svc, spreadsheet_id, sheet_name)
-
-    rows = read_queue_rows(svc, spreadsheet_id, sheet_name)
-    now = datetime.now(JST)
-
-    candidates: List[Tuple[datetime, Dict[str, Any]]] = []
-    for r in rows:
-        if not str(r["scheduled_at"]).strip():
-            continue
-        if str(r["tweet_id"]).strip():
-            continue
-        if r["status"] not in ("PENDING", "READY"):
-            continue
-        if not str(r["text"]).strip():
-            continue
+    creds = get_sheets_credentials(service_account_file, service_account_json)
+
+    # 未投稿の先頭行カーソル。QUEUE_FULL_SCAN=true なら常に全行を読む
+    full_scan = os.getenv("QUEUE_FULL_SCAN", "false").lower() in ("1", "true", "yes", "y", "on")
+
+    # カーソルとレート窓は DeveloperMetadata から1回で読む。
+    # レート窓はプロセスをまたいで保存するので monotonic ではなく壁時計で測る
+    now_ts = time.time()
+    meta = read_metadata(creds, spreadsheet_id, [next_row_key(sheet_name), RATE_WINDOW_KEY])
+    cursor_id, cursor_value = meta.get(next_row_key(sheet_name), (None, ""))
+    rate_id, rate_value = meta.get(RATE_WINDOW_KEY, (None, ""))
+    next_row, cursor_tweet_id = parse_cursor(cursor_value)
+    window_start, rate_count = parse_rate_window(rate_value, now_ts)
+    rate_count_before = rate_count
+
+    # カーソルの直前行（投稿済みのはず）も一緒に読み、tweet_id が保存値と一致するか確かめる。
+    # 行の削除や並べ替えでずれていたら、この実行の中で先頭から読み直す
+    start_row = 2 if full_scan or next_row <= 2 else next_row - 1
+    rows = read_queue_rows(creds, spreadsheet_id, sheet_name, start_row)
+    if start_row > 2 and (
+        not cursor_tweet_id or not rows or rows[0]["tweet_id"] != cursor_tweet_id
+    ):
+        print(f"CURSOR mismatch at row {start_row} -> full scan")
+        start_row = 2
+        rows = read_queue_rows(creds, spreadsheet_id, sheet_name, start_row)
+
+    pending_writes: List[Dict[str, Any]] = []
+    posted_tweet_ids: Dict[int, str] = {}  # row_index -> この実行で投稿した tweet_id
+    posted = 0
+    try:
+        # 現在時刻は1回だけ取得し、posted_at の文字列もここで作っておく
+        now = datetime.fromtimestamp(now_ts, JST)
+        now_str = now.strftime("%Y-%m-%d %H:%M")
+        now_epoch = int(now_ts)
+
+        # 比較/ソートは datetime ではなく epoch 秒 (int) で行う
+        candidates: List[Tuple[int, Dict[str, Any]]] = []
+        for r in rows:
+            if not r["scheduled_at"]:
+                continue
+
+            # 未来日時の行が大半なので、まず予定時刻で弾く
+            try:
+                sched: Optional[int] = int(parse_scheduled_at(r["scheduled_at"]).timestamp())
+            except Exception:
+                sched = None
+            if sched is not None and sched > now_epoch:
+                continue
+
+            if r["tweet_id"]:
+                continue
+            if r["status"] not in VALID_STATUSES:
+                continue
+            if not r["text"]:
+                continue
+
+            if sched is None:
+                update_row_status(
+                    pending_writes,
+                    sheet_name,
+                    r["row_index"],
+                    status="ERROR",
+                    posted_at=r["posted_at"],
+                    tweet_id=r["tweet_id"],
+                    error_message="invalid scheduled_at",
+                )
+                continue
 
-        try:
-            sched = parse_scheduled_at(str(r["scheduled_at"]))
-        except Exception:
-            new_row = [
-                str(r["scheduled_at"]),
-                str(r["text"]),
-                str(r["media_path"]),
-                "ERROR",
-                str(r["posted_at"]),
-                str(r["tweet_id"]),
-                "invalid scheduled_at",
-            ]
-            update_row_full(svc, spreadsheet_id, sheet_name, r["row_index"], new_row)
-            continue
-
-        if sched <= now:
             candidates.append((sched, r))
 
-    candidates.sort(key=lambda x: x[0])
-    candidates = candidates[:max_posts_per_run]
-
-    posted = 0
-    for _, r in candidates:
+        # 全件ソートせず、古い順に必要な件数だけ取り出す
+        candidates = heapq.nsmallest(max_posts_per_run, candidates, key=lambda x: x[0])
+
+        # レート枠に収まる分だけ投稿（古い順を崩さないよう、収まらなくなった時点で打ち切る）
+        budget = RATE_LIMIT - rate_count
+        admitted = 0
+        for _, r in candidates:
+            if request_cost(r) > budget:
+                break
+            budget -= request_cost(r)
+            admitted += 1
+        if admitted < len(candidates):
+            wait = int(window_start + RATE_WINDOW_SEC - now_ts)
+            print(
+                f"RATE LIMIT {rate_count}/{RATE_LIMIT} used -> "
+                f"defer {len(candidates) - admitted} row(s), window resets in {wait}s"
+            )
+            candidates = candidates[:admitted]
+
+        results, sent = post_rows(auth, [r for _, r in candidates])
+        rate_count += sent
+        for r, tid, err in results:
+            if err is None:
+                update_row_status(
+                    pending_writes,
+                    sheet_name,
+                    r["row_index"],
+                    status="POSTED",
+                    posted_at=now_str,
+                    tweet_id=tid,
+                    error_message="",
+                )
+                print(f"POSTED row={r['row_index']} tweet_id={tid}")
+                posted_tweet_ids[r["row_index"]] = tid
+                posted += 1
+            else:
+                msg = str(err)[:500]
+                update_row_status(
+                    pending_writes,
+                    sheet_name,
+                    r["row_index"],
+                    status="ERROR",
+                    posted_at=r["posted_at"],
+                    tweet_id=r["tweet_id"],
+                    error_message=msg,
+                )
+                print(f"ERROR row={r['row_index']} err={msg}")
+    finally:
+        flushed = False
         try:
-            text = str(r["text"])
-            if len(text) > MAX_TWEET_LEN:
-                raise ValueError(f"text too long: {len(text)} (limit {MAX_TWEET_LEN})")
-
-            media_id: Optional[str] = None
-            media_path = str(r["media_path"]).strip()
-            if media_path:
-                media_id = upload_media(auth, media_path)
-
-            tid = post_to_x(auth, text, media_id=media_id)
-
-            new_row = [
-                str(r["scheduled_at"]),
-                str(r["text"]),
-                str(r["media_path"]),
-                "POSTED",
-                now_jst_str(),
-                tid,
-                "",
-            ]
-            update_row_full(svc, spreadsheet_id, sheet_name, r["row_index"], new_row)
-            print(f"POSTED row={r['row_index']} tweet_id={tid}")
-            posted += 1
-
-        except Exception as e:
-            msg = str(e)[:500]
-            new_row = [
-                str(r["scheduled_at"]),
-                str(r["text"]),
-                str(r["media_path"]),
-                "ERROR",
-                str(r["posted_at"]),
-                str(r["tweet_id"]),
-                msg,
-            ]
-            update_row_full(svc, spreadsheet_id, sheet_name, r["row_index"], new_row)
-            print(f"ERROR row={r['row_index']} err={msg}")
+            # 途中で例外が出ても、それまでの更新は必ず書き戻す
+            flush_writes(creds, spreadsheet_id, pending_writes)
+            flushed = True
+        finally:
+            meta_updates: List[Tuple[str, Optional[int], str]] = []
+
+            # レート枠の消費は書き込み失敗時も記録する
+            if rate_count != rate_count_before:
+                meta_updates.append((RATE_WINDOW_KEY, rate_id, f"{window_start:.0f},{rate_count}"))
+
+            # 書き込み成功後にカーソルを進める（投稿済みでない最初の行まで）
+            if flushed:
+                tweet_ids = {
+                    r["row_index"]: r["tweet_id"] or posted_tweet_ids.get(r["row_index"], "")
+                    for r in rows
+                }
+                new_next_row = start_row + len(rows)
+                for r in rows:
+                    if not tweet_ids[r["row_index"]]:
+                        new_next_row = r["row_index"]
+                        break
+                new_cursor = f"{new_next_row},{tweet_ids.get(new_next_row - 1, '')}"
+                if new_cursor != cursor_value:
+                    meta_updates.append((next_row_key(sheet_name), cursor_id, new_cursor))
+
+            save_metadata(creds, spreadsheet_id, meta_updates)
 
     if posted == 0:
         print("No posts to send now.")